@@ -1,33 +1,136 @@
-import ast
 import asyncio
+import json
 import os
+import re
+import sys
+import time
 from contextlib import AsyncExitStack
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
-from dotenv import load_dotenv
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from openai import OpenAI
+from aioconsole import ainput
+
+if TYPE_CHECKING:
+    from mcp import ClientSession
+
+
+SYSTEM_PROMPT = """
+You are a specialized assistant for estimating peak memory usage of scripts using the Model Context Protocol (MCP). Your goal is to provide accurate memory usage predictions by analyzing script content and characteristics.
+
+## Available Tools:
+1. `get_script_contents` - Retrieves and formats script content with appropriate code highlighting
+2. `get_file_size` - Provides the file size in `bytes` for memory baseline estimation
+3. `get_file_sizes` - Provides the file sizes in `bytes` for several files at once
+4. `list_referenced_files` - Lists the local modules and data files a Python script references
+
+Script contents and file sizes that are already provided in the conversation can be used directly, only call the tools for what is missing.
+
+## Analysis Process:
+1. First use `get_script_contents` to examine the full script
+2. Identify all relevant files that will be executed or loaded during runtime, and analyze the code for:
+- Key dependencies and imports
+- Data structures and their growth patterns
+- Memory-intensive operations (large matrix operations, data loading)
+- Resource allocation/deallocation patterns
+- Loops that accumulate data
+- Recursive functions and their depth
+3. Pass all file paths used in the script to `get_file_sizes` in a single call to establish a baseline for static memory requirements
+4. Consider language-specific memory characteristics:
+- Python: NumPy/Pandas/TensorFlow operations, list/dictionary comprehensions, unbounded append operations in loops
+- JavaScript: large array operations, memory leaks from closures, event listeners that might prevent garbage collection
+- Compiled languages (C/C++/Rust): manual memory allocation/deallocation, potential memory leaks, large static allocations
+
+## Estimation:
+1. Baseline: runtime environment overhead (Python interpreter: ~15-30MB, Node.js: ~40-60MB, etc.), static code size and input data size (from the `bytes` of each file) and imported libraries' typical memory footprint
+2. Dynamic memory: size of data structures at their peak, operations like matrix multiplication (rows × columns × data type size), temporary variables and intermediate results, garbage collection cycles and memory retention
+
+## Output Format:
+- Minimum, expected peak and worst-case memory usage in appropriate units (KB/MB/GB)
+- Breakdown by major components (e.g., "Data loading: ~500MB, Model training: ~2GB")
+- Confidence level in your estimation (high/medium/low) and the key factors that could significantly increase memory usage
+- Optimization recommendations, e.g. chunking or streaming data
+
+Remember that dynamic memory usage often exceeds static file size by orders of magnitude, especially for data processing scripts. Give your most confident estimation.
+""".strip()
+
+# Sent byte-identical as the first message of every request so the provider's
+# implicit prefix cache can be reused across queries
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": SYSTEM_PROMPT,
+}
+
+# Tool-calling rounds before the model is asked to answer without tools
+MAX_TOOL_ROUNDS = 8
+
+# Python scripts mentioned in a query, prefetched before the first LLM call
+_SCRIPT_PATH = re.compile(r"[\w./~-]+\.py\b")
+
+
+def _tool_result_text(result) -> str:
+    return "\n".join(content.text for content in result.content if hasattr(content, "text"))
+
+
+class _CoalescingWriter:
+    """Buffer streamed deltas and write them to stdout in batches"""
+
+    def __init__(self, interval: float = 0.02, max_size: int = 256):
+        self.interval = interval
+        self.max_size = max_size
+        self._buffer: list[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size > self.max_size or time.monotonic() - self._last_flush > self.interval:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            sys.stdout.write("".join(self._buffer))
+            sys.stdout.flush()
+            self._buffer.clear()
+            self._size = 0
+        self._last_flush = time.monotonic()
 
-load_dotenv()  # load environment variables from .env
 
 class MCPClient:
     def __init__(self):
         # Initialize session and client objects
-        self.session: Optional[ClientSession] = None
-        self.exit_stack = AsyncExitStack()
-        self.llm_client = OpenAI(
+        self.session: Optional["ClientSession"] = None
+        self.tools: list[dict] = []
+        self.exit_stack: Optional[AsyncExitStack] = None
+        # openai is imported lazily, it dominates the import time of the CLI
+        from openai import AsyncOpenAI
+
+        self.llm_client = AsyncOpenAI(
             api_key = os.getenv("DASHSCOPE_API_KEY"),
             base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
         )
     # methods will go here
 
+    async def __aenter__(self):
+        self.exit_stack = AsyncExitStack()
+        await self.exit_stack.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # cleanup() may already have closed the stack
+        if self.exit_stack is None:
+            return False
+        exit_stack, self.exit_stack = self.exit_stack, None
+        return await exit_stack.__aexit__(*exc_info)
+
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
 
         Args:
             server_script_path: Path to the server script (.py or .js)
         """
+        from mcp import ClientSession, StdioServerParameters
+        from mcp.client.stdio import stdio_client
+
         is_python = server_script_path.endswith('.py')
         is_js = server_script_path.endswith('.js')
         if not (is_python or is_js):
@@ -40,6 +143,9 @@ class MCPClient:
             env=None
         )
 
+        if self.exit_stack is None:
+            # Not entered with `async with`, the caller has to call cleanup()
+            self.exit_stack = AsyncExitStack()
         stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
         self.stdio, self.write = stdio_transport
         self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
@@ -51,197 +157,138 @@ class MCPClient:
         tools = response.tools
         print("\nConnected to server with tools:", [tool.name for tool in tools])
 
+        # Expose the MCP tools to the LLM as OpenAI-compatible functions
+        self.tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.inputSchema,
+                },
+            }
+            for tool in tools
+        ]
+
+    async def _prefetch_script(self, script_path: str) -> list[dict]:
+        """Fetch a script and the sizes of the files it references without the LLM"""
+
+        async def referenced_file_sizes():
+            result = await self.session.call_tool("list_referenced_files", {'file_path': script_path})
+            if result.isError:
+                return result
+            files = [content.text for content in result.content if hasattr(content, "text")]
+            return await self.session.call_tool("get_file_sizes", {'file_paths': files})
+
+        contents, file_sizes = await asyncio.gather(
+            self.session.call_tool("get_script_contents", {'file_path': script_path}),
+            referenced_file_sizes(),
+        )
+        # Each part is only sent if its own lookup succeeded
+        prefetched = []
+        if not contents.isError:
+            prefetched.append({"role": "user", "content": f"Script {script_path}:\n{_tool_result_text(contents)}"})
+        if not file_sizes.isError:
+            prefetched.append({"role": "user", "content": f"File sizes:\n{_tool_result_text(file_sizes)}"})
+        return prefetched
+
     async def process_query(self, query: str) -> str:
         """Process a query using LLM and available tools"""
         messages = [
+            SYSTEM_MESSAGE,
             {
                 "role": "user",
-                "content": f"""
-                {query}
-                \nYou are a specialized assistant for estimating peak memory usage of scripts using the Model Context Protocol (MCP). Your goal is to provide accurate memory usage predictions by analyzing script content and characteristics.
-
-                ## Available Tools:
-                1. `get_file_content` - Retrieves and formats script content with appropriate code highlighting
-                2. `get_file_size` - Provides file size information for memory baseline estimation
-
-                ## Analysis Process:
-                1. First use `get_file_content` to examine the full script
-                2. Analyze the code for:
-                - Data structures and their growth patterns
-                - Memory-intensive operations (large matrix operations, data loading)
-                - Resource allocation/deallocation patterns
-                - Loops that accumulate data
-                - Recursive functions and their depth
-                3. Use `get_file_size` to establish a baseline for static memory requirements
-                4. Consider language-specific memory characteristics (Python's overhead vs C/C++)
-
-                ## Output Format:
-                - Provide estimated peak memory range in appropriate units (KB/MB/GB)
-                - Break down memory usage by major components
-                - Highlight potential memory bottlenecks
-                - Suggest optimization opportunities if applicable
-
-                Remember that dynamic memory usage often exceeds static file size by orders of magnitude, especially for data processing scripts.
-
-                """
-            }
+                "content": query,
+            },
         ]
 
-        ## STEP1: Get all file paths of files used in the script
-        file_size_answer = ""
-        is_answering = False
-
-        tool_name = "get_script_contents"
-        tool_args = {'file_path': "cena.py"}
-
-        # Execute tool call
-        result = await self.session.call_tool(tool_name, tool_args)
-
-        messages.append({
-            "role": "assistant",
-            "content": f"""
-                I'm providing you with script content via the get_file_content tool. Your task is to:
-                1. Identify all relevant files that will be executed or loaded during runtime
-                2. For each file, provide:
-                - Filename
-                - Language/runtime environment
-                - Primary purpose of the file
-                - Key dependencies and imports
-                - Data structures being used
-                - Any memory-intensive operations (e.g., large data loading, matrix operations, recursive functions)
-                - Growth patterns for variables and data structures
-                - Potential memory bottlenecks
-
-                Format your response as a structured analysis with separate sections for each file. Highlight any files that appear particularly memory-intensive.
-
-                For Python files, pay special attention to:
-                - NumPy/Pandas/TensorFlow operations
-                - Large data loading operations
-                - List/dictionary comprehensions
-                - Unbounded append operations in loops
-                - Recursive functions without clear termination conditions
-
-                For JavaScript files, focus on:
-                - Large array operations
-                - DOM manipulation
-                - Memory leaks from closures
-                - Event listeners that might prevent garbage collection
-
-                For compiled languages (C/C++/Rust), note:
-                - Manual memory allocation/deallocation
-                - Potential memory leaks
-                - Large static allocations
-
-                List all files that should be analyzed with the get_file_size tool in the next step.
-                \nHere are the contents of the script:
-                \n{result.content}
-                \nPlease get all file paths of files used in the script and collect them into a list
-                \nOnly give me the list of paths. Do not include any other information
-            """
-        })
-        response = self.llm_client.chat.completions.create(
-            model="deepseek-r1",
-            messages=messages,
-            stream=True,
-            # stream_options={
-            #     "include_usage": True
-            # }
-        )
-        for chunk in response:
-            if not chunk.choices:
-                print("\nUsage:")
-                print(chunk.usage)
-            else:
-                delta = chunk.choices[0].delta
-                # print reasoning content
-                if hasattr(delta, 'reasoning_content') and delta.reasoning_content != None:
-                    print(delta.reasoning_content, end='', flush=True)
-                else:
-                    # answer
-                    if delta.content != "" and is_answering is False:
-                        print("\n" + "=" * 20 + "Answer" + "=" * 20 + "\n")
-                        is_answering = True
-                    print(delta.content, end='', flush=True)
-                    file_size_answer += delta.content
-
-
-        file_sizes = {}
-        tool_name = "get_file_size"
-        for file in ast.literal_eval(file_size_answer):
-            tool_args = {'file_path': file}
-
-            # Execute tool call
-            result = await self.session.call_tool(tool_name, tool_args)
-            file_sizes[file] = result.content
-
-        ## STEP2: Infer the memory usage from the file infos and estimate the memory usage of the script
-        messages.append({
-            "role": "assistant",
-            "content": f"""
-                Based on the file analysis from the previous step, I've provided file size information using the get_file_size tool. Now, estimate the peak memory usage during script execution by:
-
-                1. Starting with baseline memory requirements:
-                - Runtime environment overhead (Python interpreter: ~15-30MB, Node.js: ~40-60MB, etc.)
-                - Static code size (from get_file_size results)
-                - Imported libraries' typical memory footprint
-
-                2. Analyzing dynamic memory patterns:
-                - Estimate size of data structures at their peak
-                - Calculate memory for operations like matrix multiplication (rows × columns × data type size)
-                - Account for temporary variables and intermediate results
-                - Consider garbage collection cycles and memory retention
-
-                3. Provide a comprehensive estimate with:
-                - Minimum memory requirement
-                - Expected peak memory usage
-                - Worst-case scenario memory usage
-                - Breakdown by major components (e.g., "Data loading: ~500MB, Model training: ~2GB")
-                - Confidence level in your estimation (high/medium/low)
-                - Key factors that could significantly increase memory usage
-
-                4. Optimization recommendations:
-                - Specific code sections that could be optimized
-                - Alternative approaches for memory-intensive operations
-                - Potential for chunking or streaming data
-
-                Present your analysis in a clear, structured format with quantitative estimates where possible. If there's significant uncertainty in any area, explain the factors contributing to that uncertainty.
-                \nHere are the file sizes of the files used in the script:
-                \n{file_sizes}
-                \nInfer the memory usage from these file infos and estimate the memory usage of the script
-                \nAnd give me your most confident estimation
-            """
-        })
-
-        is_answering = False
-        answer_content = ""
-
-        response = self.llm_client.chat.completions.create(
-            model="deepseek-r1",
-            messages=messages,
-            stream=True,
-            # stream_options={
-            #     "include_usage": True
-            # }
-        )
-        for chunk in response:
-            if not chunk.choices:
-                print("\nUsage:")
-                print(chunk.usage)
-            else:
-                delta = chunk.choices[0].delta
-                # print reasoning content
-                if hasattr(delta, 'reasoning_content') and delta.reasoning_content != None:
-                    print(delta.reasoning_content, end='', flush=True)
+        # Speculatively fetch the scripts named in the query, so the model can
+        # usually answer without a tool round trip
+        script_paths = list(dict.fromkeys(_SCRIPT_PATH.findall(query)))
+        for prefetched in await asyncio.gather(*(self._prefetch_script(path) for path in script_paths)):
+            messages.extend(prefetched)
+
+        # Let the model call the MCP tools until it returns a final answer, the
+        # last round is sent without tools so it has to answer
+        for tool_round in range(MAX_TOOL_ROUNDS + 1):
+            is_answering = False
+            answer_content = ""
+            tool_calls = {}
+            is_last_round = tool_round == MAX_TOOL_ROUNDS
+
+            response = await self.llm_client.chat.completions.create(
+                model="deepseek-r1",
+                messages=messages,
+                **({} if is_last_round else {"tools": self.tools}),
+                stream=True,
+                # stream_options={
+                #     "include_usage": True
+                # }
+            )
+            writer = _CoalescingWriter()
+            async for chunk in response:
+                if not chunk.choices:
+                    writer.flush()
+                    print("\nUsage:")
+                    print(chunk.usage)
                 else:
-                    # answer
-                    if delta.content != "" and is_answering is False:
-                        print("\n" + "=" * 20 + "Answer" + "=" * 20 + "\n")
-                        is_answering = True
-                    print(delta.content, end='', flush=True)
-                    answer_content += delta.content
-
-
-        return answer_content
+                    delta = chunk.choices[0].delta
+                    # collect tool calls, which are streamed in fragments
+                    for tool_call in delta.tool_calls or []:
+                        call = tool_calls.setdefault(tool_call.index, {"id": "", "name": "", "arguments": ""})
+                        if tool_call.id:
+                            call["id"] = tool_call.id
+                        if tool_call.function and tool_call.function.name:
+                            call["name"] = tool_call.function.name
+                        if tool_call.function and tool_call.function.arguments:
+                            call["arguments"] += tool_call.function.arguments
+                    # print reasoning content
+                    if hasattr(delta, 'reasoning_content') and delta.reasoning_content != None:
+                        writer.write(delta.reasoning_content)
+                    elif delta.content:
+                        # answer
+                        if is_answering is False:
+                            writer.write("\n" + "=" * 20 + "Answer" + "=" * 20 + "\n\n")
+                            is_answering = True
+                        writer.write(delta.content)
+                        answer_content += delta.content
+            writer.flush()
+
+            if not tool_calls or is_last_round:
+                return answer_content
+
+            calls = [tool_calls[index] for index in sorted(tool_calls)]
+            messages.append({
+                "role": "assistant",
+                "content": answer_content,
+                "tool_calls": [
+                    {
+                        "id": call["id"],
+                        "type": "function",
+                        "function": {"name": call["name"], "arguments": call["arguments"]},
+                    }
+                    for call in calls
+                ],
+            })
+
+            # Execute tool calls concurrently
+            results = await asyncio.gather(*(self._call_tool(call) for call in calls))
+            for call, result in zip(calls, results):
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": call["id"],
+                    "content": result,
+                })
+
+    async def _call_tool(self, call: dict) -> str:
+        """Run a tool call requested by the LLM and return its result as text"""
+        try:
+            arguments = json.loads(call["arguments"] or "{}")
+        except json.JSONDecodeError as e:
+            # Let the model retry instead of failing the whole query
+            return f"Error: invalid JSON arguments for {call['name']}: {e}"
+        result = await self.session.call_tool(call["name"], arguments)
+        return _tool_result_text(result)
 
     async def chat_loop(self):
         """Run an interactive chat loop"""
@@ -250,7 +297,7 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                query = (await ainput("\nQuery: ")).strip()
 
                 if query.lower() == 'quit':
                     break
@@ -262,21 +309,23 @@ class MCPClient:
                 print(f"\nError: {str(e)}")
 
     async def cleanup(self):
-        """Clean up resources"""
-        await self.exit_stack.aclose()
+        """Clean up resources when the client is not used with `async with`"""
+        if self.exit_stack is not None:
+            exit_stack, self.exit_stack = self.exit_stack, None
+            await exit_stack.aclose()
 
 async def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()  # load environment variables from .env
+
     if len(sys.argv) < 2:
         print("Usage: python client.py <path_to_server_script>")
         sys.exit(1)
 
-    client = MCPClient()
-    try:
+    async with MCPClient() as client:
         await client.connect_to_server(sys.argv[1])
         await client.chat_loop()
-    finally:
-        await client.cleanup()
 
 if __name__ == "__main__":
-    import sys
     asyncio.run(main())
\ No newline at end of file
@@ -1,9 +1,26 @@
+import ast
+import os
+from functools import lru_cache
 from pathlib import Path
 
-import mistune
 from mcp.server.fastmcp import FastMCP
-from pygments import highlight
-from pygments.lexers import get_lexer_for_filename, guess_lexer
+
+_EXT_LANGUAGES = {
+    ".py": "python",
+    ".js": "javascript",
+    ".ts": "typescript",
+    ".c": "c",
+    ".cpp": "cpp",
+    ".rs": "rust",
+    ".go": "go",
+    ".sh": "bash",
+    ".r": "r",
+    ".java": "java",
+}
+
+# Upper bound on how much of a script is sent to the LLM
+MAX_SCRIPT_BYTES = 128 * 1024
+_TRUNCATION_MARKER = "\n... [truncated] ...\n"
 
 
 class ContentBuilder:
@@ -17,38 +34,50 @@ class ContentBuilder:
         return cls(code, language)
 
     def build(self):
-        return mistune.markdown(self.content)
+        # The consumer is an LLM prompt, so the fenced source is returned as is
+        return self.content
 
 
 def _wrap_content(content: str, file_type: str):
     return f"```{{{file_type}}}\n{content}\n```"
 
 
-def _preprocess_script(file_path: str | Path):
+def _read_script(file_path: Path, max_bytes: int = MAX_SCRIPT_BYTES) -> str:
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= max_bytes:
+            return f.read().decode(errors="replace")
+        # Keep both ends of large scripts, e.g. the imports and the entry point
+        half = max_bytes // 2
+        head = f.read(half)
+        f.seek(-half, os.SEEK_END)
+        tail = f.read()
+    return head.decode(errors="replace") + _TRUNCATION_MARKER + tail.decode(errors="replace")
+
+
+def _preprocess_script(file_path: str | Path, guess_language: bool = False):
     if isinstance(file_path, str):
         file_path = Path(file_path)
 
-    code = None
-    if file_path and file_path.exists():
-        try:
-            lexer = get_lexer_for_filename(file_path)
-            with open(file_path, "r") as f:
-                code = f.read()
-        except Exception as e:
-            print(f"Error detecting language from filename: {e}")
-            # Fallback to content-based detection
-            with open(file_path, "r") as f:
-                code = f.read()
-            lexer = guess_lexer(code)
-    elif code is not None:
-        # Try to guess the lexer based on content
+    if not (file_path and file_path.exists()):
+        raise ValueError("file_path must point to an existing file")
+
+    code = _read_script(file_path)
+    language = _EXT_LANGUAGES.get(file_path.suffix.lower(), "text")
+    if language == "text" and guess_language:
+        # Fallback to content-based detection
+        from pygments.lexers import guess_lexer
+
         lexer = guess_lexer(code)
-    else:
-        raise ValueError("Either file_path or code must be provided")
-    language = lexer.aliases[0] if lexer.aliases else "text"
+        language = lexer.aliases[0] if lexer.aliases else "text"
     code = _wrap_content(code, language)
     return language, code
 
+
+@lru_cache(maxsize=256)
+def _build_cached(file_path: str, mtime_ns: int, size: int) -> str:
+    # mtime and size are only part of the cache key, so edited files are rebuilt
+    return ContentBuilder.from_file(file_path).build()
+
 from pathlib import Path
 
 # Initialize FastMCP server
@@ -57,30 +86,113 @@ mcp = FastMCP("optslurm")
 
 @mcp.tool()
 async def get_script_contents(file_path: str | Path) -> str:
-    """Get weather alerts for a US state.
+    """Get the contents of a script as a fenced code block.
 
     Args:
-        state: Two-letter US state code (e.g. CA, NY)
+        file_path: Path of the script to read
     """
-    code_blocks = ContentBuilder.from_file(file_path).build()
+    file_path = Path(file_path).expanduser()
+    stat = file_path.stat()
+    code_blocks = _build_cached(str(file_path), stat.st_mtime_ns, stat.st_size)
     return code_blocks  # type: ignore
 
 
 @mcp.tool()
-async def get_file_size(file_path: str | Path) -> str:
-    """Get weather forecast for a location.
+async def get_file_size(file_path: str) -> dict:
+    """Get the size of a file in bytes.
 
     Args:
-        latitude: Latitude of the location
-        longitude: Longitude of the location
+        file_path: Path of the file to inspect
     """
-    if isinstance(file_path, str):
-        file_path = Path(file_path)
+    try:
+        return {"bytes": os.stat(file_path).st_size}
+    except OSError as e:
+        return {"error": e.strerror or str(e)}
+
+
+@mcp.tool()
+async def get_file_sizes(file_paths: list[str]) -> dict[str, dict]:
+    """Get the sizes of several files in bytes in a single call.
 
-    if file_path.exists():
-        return f"File size: {file_path.stat().st_size / 1024 / 1024 } MB"
+    Args:
+        file_paths: Paths of the files to inspect
+    """
+    return {file_path: await get_file_size(file_path) for file_path in file_paths}
+
+
+def _module_file(script_dir: Path, module: str) -> Path | None:
+    module_path = script_dir.joinpath(*module.split("."))
+    for candidate in (module_path.with_suffix(".py"), module_path / "__init__.py"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def _opens_for_writing(node: ast.Call) -> bool:
+    if len(node.args) > 1:
+        mode = node.args[1]
     else:
-        return "File not found"
+        mode = next((keyword.value for keyword in node.keywords if keyword.arg == "mode"), None)
+    return isinstance(mode, ast.Constant) and isinstance(mode.value, str) and any(c in mode.value for c in "wax")
+
+
+@mcp.tool()
+async def list_referenced_files(file_path: str) -> list[str]:
+    """List the files a Python script references: the script itself, local
+    modules it imports and files passed to open() or other calls.
+
+    Local imports are resolved against the directory of the script, like
+    Python does through sys.path[0], and relative imports against the
+    directory their leading dots point to. Literal paths are resolved against the
+    working directory, which the server inherits from the client. open()
+    paths are listed unless opened for writing, paths passed to other calls
+    only if they exist.
+
+    Args:
+        file_path: Path of the Python script to inspect
+    """
+    script = Path(file_path).expanduser()
+    if script.suffix.lower() != ".py":
+        return [str(script)]
+    try:
+        tree = ast.parse(script.read_bytes(), filename=str(script))
+    except (OSError, SyntaxError):
+        # Leave unreadable scripts to the size lookup, which reports the error
+        return [str(script)]
+
+    referenced = [str(script)]
+    for node in ast.walk(tree):
+        base_dir = script.parent
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            # Each leading dot after the first goes up one directory
+            for _ in range(node.level - 1):
+                base_dir = base_dir.parent
+            modules = [node.module] if node.module else [alias.name for alias in node.names]
+        elif (
+            isinstance(node, ast.Call)
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+        ):
+            # Any string literal may end up here, and Python does not expand ~
+            # in file paths either, so it is left as is
+            path = node.args[0].value
+            if isinstance(node.func, ast.Name) and node.func.id == "open":
+                # open() always refers to a file, but outputs are not inputs
+                if not _opens_for_writing(node):
+                    referenced.append(path)
+            elif os.path.isfile(path):
+                referenced.append(path)
+            continue
+        else:
+            continue
+        for module in modules:
+            module_file = _module_file(base_dir, module)
+            if module_file is not None:
+                referenced.append(str(module_file))
+    return list(dict.fromkeys(referenced))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import asyncio
+
+from server import list_referenced_files
+
+
+def test_list_referenced_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    script_dir = tmp_path / "scripts"
+    script_dir.mkdir()
+    (script_dir / "helper.py").write_text("x = 1\n")
+    (tmp_path / "data.npy").write_bytes(b"")
+    script = script_dir / "main.py"
+    script.write_text(
+        "import helper\n"
+        "import numpy as np\n"
+        "arr = np.load('data.npy')\n"
+        "skipped = np.load('missing.npy')\n"
+        "with open('config.txt') as f:\n"
+        "    pass\n"
+        "with open('out.txt', 'w') as f:\n"
+        "    pass\n"
+        "log = open('log.txt', mode='a')\n"
+    )
+
+    referenced = asyncio.run(list_referenced_files(str(script)))
+
+    assert referenced == [
+        str(script),
+        str(script_dir / "helper.py"),
+        "data.npy",
+        "config.txt",
+    ]
+
+
+def test_list_referenced_files_ignores_tilde_literals(tmp_path):
+    script = tmp_path / "main.py"
+    script.write_text(
+        "print('~ starting job')\n"
+        "open('~baduser/data.csv')\n"
+    )
+
+    referenced = asyncio.run(list_referenced_files(str(script)))
+
+    assert referenced == [str(script), "~baduser/data.csv"]
+
+
+def test_list_referenced_files_relative_imports(tmp_path):
+    package_dir = tmp_path / "pkg" / "sub"
+    package_dir.mkdir(parents=True)
+    (package_dir / "utils.py").write_text("x = 1\n")
+    (tmp_path / "pkg" / "common.py").write_text("y = 2\n")
+    script = package_dir / "main.py"
+    script.write_text(
+        "from . import utils\n"
+        "from ..common import y\n"
+    )
+
+    referenced = asyncio.run(list_referenced_files(str(script)))
+
+    assert referenced == [
+        str(script),
+        str(package_dir / "utils.py"),
+        str(tmp_path / "pkg" / "common.py"),
+    ]
+
+
+def test_list_referenced_files_non_python_script(tmp_path):
+    script = tmp_path / "job.sh"
+    script.write_text("python main.py\n")
+
+    assert asyncio.run(list_referenced_files(str(script))) == [str(script)]
+
+
+def test_list_referenced_files_syntax_error(tmp_path):
+    script = tmp_path / "main.py"
+    script.write_text("def broken(:\n")
+
+    assert asyncio.run(list_referenced_files(str(script))) == [str(script)]
+
+
+def test_list_referenced_files_missing_script(tmp_path):
+    script = tmp_path / "missing.py"
+
+    assert asyncio.run(list_referenced_files(str(script))) == [str(script)]